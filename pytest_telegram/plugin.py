@@ -1,10 +1,35 @@
+import json
 import time
 import logging
 import pytest
-import requests
-from requests import exceptions
 
-logging.getLogger(__name__)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# (connect, read) timeouts for every Telegram API call
+TELEGRAM_TIMEOUT = (3.05, 10)
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+MAX_FAILED_TEST_LENGTH = 400
+MAX_FAILED_TESTS_LISTED = 50
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+SUMMARY_TEMPLATE = (
+    " ‎ 🚀 Passed: *{passed}*\n"
+    " ☠ Failed: *{failed}*\n"
+    " 😐 Skipped: *{skipped}*\n"
+    " 🗿 Errors: *{error}*\n"
+    "\n ⌛ Start time: *{start_time}* "
+    "\n ⏰ Time taken: *{hours:02}:{minutes:02}:{seconds:02}*"
+    "\n‎ ⛺ Environment: *{env}*"
+    "{report_url}{custom_text}"
+)
+
+# Characters that have to be escaped to be shown as is in a legacy Markdown message
+MARKDOWN_ESCAPES = str.maketrans({char: f'\\{char}' for char in '_*`['})
 
 def pytest_addoption(parser):
     group = parser.getgroup('telegram')
@@ -15,84 +40,190 @@ def pytest_addoption(parser):
     group.addoption('--telegram_report_url', action='store', dest='telegram_report_url', default=None, help='Report URL')
     group.addoption('--telegram_env', action='store', dest='telegram_env', default=None, help='Environment')
     group.addoption('--telegram_disable_stickers', action='store_true', dest='telegram_disable_stickers', help='Option to disable stickers')
+    group.addoption('--telegram_custom_text', action='store', dest='telegram_custom_text', default=None, help='Custom text')
+    group.addoption('--telegram_list_failed', action='store_true', dest='telegram_list_failed', help='Option to send failed tests')
+
+def _create_session():
+    # requests is imported lazily so that runs without Telegram options don't pay for it
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    # One keep-alive connection is reused for the sticker and all messages
+    session = requests.Session()
+    # POST is not retried by default. Only errors which guarantee the message wasn't delivered are retried,
+    # and Retry-After is ignored since Telegram flood control can ask to wait for tens of seconds.
+    # read=False re-raises read errors as is, so they surface as Timeout rather than ConnectionError
+    retries = Retry(total=2, connect=2, read=False, backoff_factor=0.25, status_forcelist=(429, 503),
+                    allowed_methods=frozenset(['POST']), respect_retry_after_header=False)
+    session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=retries))
+    return session
+
+
+def _session_start_time(terminalreporter):
+    # pytest 8.4 replaced the _sessionstarttime timestamp with a timing.Instant
+    session_start = getattr(terminalreporter, '_session_start', None)
+    if session_start is not None:
+        return session_start.time
+    return terminalreporter._sessionstarttime
+
+
+def _dumps(payload):
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, ensure_ascii=False).encode()
+
+
+def _post(session, url, payload):
+    return session.post(url, data=_dumps(payload), headers=JSON_HEADERS, timeout=TELEGRAM_TIMEOUT)
+
+
+def _post_in_order(session, url, payloads):
+    # Parts of one long message are sent one by one so that they show up in order
+    for payload in payloads:
+        response = _post(session, url, payload)
+        response.raise_for_status()
+    return response
+
+
+def _log_request_error(name, e):
+    from requests import exceptions
+
+    if isinstance(e, exceptions.Timeout):
+        # The report is best effort, a slow Telegram API is not worth an error
+        logger.warning("Timed out sending Telegram message: %s", str(e))
+    elif isinstance(e, exceptions.ConnectionError):
+        logger.warning("Telegram API is unreachable: %s", str(e))
+    else:
+        logger.error("Error sending Telegram message: %s", str(e))
+        # raise_for_status puts the response on the HTTPError
+        if e.response is not None:
+            logger.error("Telegram response body for %s: %s", name, e.response.text)
+
+
+def _split_lines(lines, max_length):
+    # Greedily pack lines into as few texts as possible, each no longer than max_length
+    chunks = []
+    chunk = []
+    chunk_length = 0
+    for line in lines:
+        if chunk and chunk_length + 1 + len(line) > max_length:
+            chunks.append('\n'.join(chunk))
+            chunk = []
+            chunk_length = 0
+        chunk_length += len(line) + (1 if chunk else 0)
+        chunk.append(line)
+    if chunk:
+        chunks.append('\n'.join(chunk))
+    return chunks
+
 
 @pytest.hookimpl(hookwrapper=True)
 def pytest_terminal_summary(terminalreporter, exitstatus, config):
     yield
 
-    if not config.option.telegram_token:
+    options = config.option
+    if not options.telegram_token or not options.telegram_id:
         return
 
     if hasattr(terminalreporter.config, 'workerinput'):
         return
 
+    if options.collectonly:
+        return
+
     stats = terminalreporter.stats
-    failed_tests = stats.get('failed', [])
+    failed_tests = stats.get('failed', ())
     failed_count = len(failed_tests)
-    passed_count = len(stats.get('passed', []))
-    skipped_count = len(stats.get('skipped', []))
-    error_count = len(stats.get('error', []))
+    passed_count = len(stats.get('passed', ()))
+    skipped_count = len(stats.get('skipped', ()))
+    error_count = len(stats.get('error', ()))
+    has_failures = failed_count > 0 or error_count > 0
+
+    # Nothing was run (e.g. everything was deselected), so there is nothing to report
+    if not (passed_count or failed_count or skipped_count or error_count):
+        return
 
-    token = config.option.telegram_token
+    token = options.telegram_token
     telegram_uri = f'https://api.telegram.org/bot{token}'
-    chat_id = config.option.telegram_id
+    send_sticker_url = f'{telegram_uri}/sendSticker'
+    send_message_url = f'{telegram_uri}/sendMessage'
+    chat_id = options.telegram_id
+
+    success_sticker_id = options.success_sticker_id
+    fail_sticker_id = options.fail_sticker_id
+    report_url = f'\n{options.telegram_report_url}' if options.telegram_report_url else ''
+    env = f'{options.telegram_env}'.replace('\\n', '\n') if options.telegram_env else ''
+    custom_text = f'\n{options.telegram_custom_text}'.replace('\\n', '\n') if options.telegram_custom_text else ''
+    disable_stickers = options.telegram_disable_stickers
+    list_failed = options.telegram_list_failed
 
-    success_sticker_id = config.option.success_sticker_id
-    fail_sticker_id = config.option.fail_sticker_id
-    report_url = f'\n{config.option.telegram_report_url}' if config.option.telegram_report_url else ''
-    env = f'{config.option.telegram_env}'.replace('\\n', '\n') if config.option.telegram_env else ''
-    disable_stickers = config.option.telegram_disable_stickers
+    session_start_time = _session_start_time(terminalreporter)
+    hours, remainder = divmod(int(time.time() - session_start_time), 3600)
+    minutes, seconds = divmod(remainder, 60)
+    message_text = SUMMARY_TEMPLATE.format(
+        passed=passed_count, failed=failed_count, skipped=skipped_count, error=error_count,
+        start_time=time.strftime('%d-%m-%Y %H:%M:%S', time.localtime(session_start_time)),
+        hours=hours, minutes=minutes, seconds=seconds,
+        env=env, report_url=report_url, custom_text=custom_text)
 
-    final_results = f" ‎ 🚀 Passed: *{passed_count}*\n ☠ Failed: *{failed_count}*\n 😐 Skipped: *{skipped_count}*\n 🗿 Errors: *{error_count}*\n"
-    session_time = time.time() - terminalreporter._sessionstarttime
-    session_start_time = terminalreporter._sessionstarttime
-    session_start_time_str = f'\n ⌛ Start time: {time.strftime("*%d-%m-%Y %H:%M:%S*", time.localtime(session_start_time))} '
-    time_taken = f'\n ⏰ Time taken: {time.strftime("*%H:%M:%S*", time.gmtime(session_time))}'
-    message_text = f'{final_results}{session_start_time_str}{time_taken}\n‎ ⛺ Environment: *{env}*{report_url}'
+    failed_tests_chunks = []
+    if list_failed and failed_count > 0:
+        failed_tests_details = []
+        for test_report in failed_tests[:MAX_FAILED_TESTS_LISTED]:
+            nodeid = test_report.nodeid
+            crash = getattr(test_report.longrepr, 'reprcrash', None)
+            message = crash.message if crash is not None else str(test_report.longrepr)
+            # Clean up the message to remove unwanted details
+            first_line = message.partition('\n')[0]
+            clean_message = f'{nodeid} - {first_line}'
+            if len(clean_message) > MAX_FAILED_TEST_LENGTH:
+                clean_message = f'{clean_message[:MAX_FAILED_TEST_LENGTH - 1]}…'
+            failed_tests_details.append(clean_message)
+        # A long list would take many messages and run into Telegram rate limits
+        if failed_count > MAX_FAILED_TESTS_LISTED:
+            failed_tests_details.append(f'… and {failed_count - MAX_FAILED_TESTS_LISTED} more')
+        failed_tests_text = '\n'.join(failed_tests_details)
 
+        # Send the failed tests within the summary when both fit into one message
+        combined_text = f'{message_text}\n\n{failed_tests_text.translate(MARKDOWN_ESCAPES)}'
+        if len(combined_text) <= TELEGRAM_MAX_MESSAGE_LENGTH:
+            message_text = combined_text
+        else:
+            failed_tests_chunks = _split_lines(failed_tests_details, TELEGRAM_MAX_MESSAGE_LENGTH)
+
+    from requests import exceptions
+
+    session = _create_session()
     try:
         message_id = None
         if not disable_stickers:
-            sticker_payload = {'chat_id': chat_id, 'sticker': success_sticker_id if failed_count == 0 and error_count == 0 else fail_sticker_id}
-            sticker_response = requests.post(f'{telegram_uri}/sendSticker', json=sticker_payload)
+            sticker_payload = {'chat_id': chat_id, 'sticker': fail_sticker_id if has_failures else success_sticker_id}
+            sticker_response = _post(session, send_sticker_url, sticker_payload)
             sticker_response.raise_for_status()
             message_id = sticker_response.json().get('result', {}).get('message_id')
 
-        # Send the summary message
         message_payload = {
             'chat_id': chat_id,
             'text': message_text,
             'reply_to_message_id': message_id,
             'parse_mode': 'Markdown'
         }
-        message_response = requests.post(f'{telegram_uri}/sendMessage', json=message_payload)
-        message_response.raise_for_status()
-        logging.debug("Summary message sent successfully: %s", message_response.json())
-
-        # Send a separate message for failed tests if there are any
-        if failed_count > 0:
-            failed_tests_details = []
-            for test_report in failed_tests:
-                nodeid = test_report.nodeid
-                if hasattr(test_report.longrepr, 'reprcrash'):
-                    message = f'{nodeid} - {test_report.longrepr.reprcrash.message}'
-                else:
-                    message = f'{nodeid} - {test_report.longrepr}'
-                # Clean up the message to remove unwanted details
-                clean_message = message.split('\n')[0]
-                failed_tests_details.append(clean_message)
-
-            failed_message_payload = {
-                'chat_id': chat_id,
-                'text': '\n'.join(failed_tests_details)
-            }
-            failed_message_response = requests.post(f'{telegram_uri}/sendMessage', json=failed_message_payload)
-            failed_message_response.raise_for_status()
-            logging.debug("Failed tests message sent successfully: %s", failed_message_response.json())
+        # The failed tests list is sent after the summary, so that it shows up below it in the chat
+        messages = {'Summary': [message_payload]}
+        if failed_tests_chunks:
+            messages['Failed tests'] = [{'chat_id': chat_id, 'text': chunk} for chunk in failed_tests_chunks]
+
+        for name, payloads in messages.items():
+            try:
+                response = _post_in_order(session, send_message_url, payloads)
+                # Don't parse the response body just to drop it when debug logging is off
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("%s message sent successfully: %s", name, response.json())
+            except exceptions.RequestException as e:
+                _log_request_error(f'{name.lower()} message', e)
 
     except exceptions.RequestException as e:
-        logging.error("Error sending Telegram message: %s", str(e))
-        if 'message_response' in locals():
-            logging.error("Telegram response body: %s", message_response.text)
-        if 'failed_message_response' in locals():
-            logging.error("Telegram response body for failed tests: %s", failed_message_response.text)
+        _log_request_error('sticker', e)
+    finally:
+        session.close()
@@ -11,7 +11,7 @@ with open('README.rst') as readme_file:
 with open('HISTORY.rst') as history_file:
     history = history_file.read()
 
-requirements = ['requests']
+requirements = ['requests', 'urllib3>=1.26']
 
 setup_requirements = ['pytest-runner', ]
 
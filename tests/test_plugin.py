@@ -1,5 +1,12 @@
+import io
+import json
+from types import SimpleNamespace
+
 import mock
 import pytest
+# Imported up front so that pytester keeps the same requests and urllib3 modules between in-process runs
+import requests  # noqa: F401
+import urllib3
 
 
 def test_pytest_telegram(testdir):
@@ -38,26 +45,29 @@ def test_pytest_telegram(testdir):
     telegram_token = 'Token'
     telegram_chat_id = '130559633'
     telegram_report_url = 'http://report_link.com'
-    fail_sticker_id = 'CAACAgIAAxkBAAMIX8rohSxoNbodB1D38VZx9HI2CDwAAmIBAAIQGm0izcITZBkXtbceBA'
-    expected_text = 'Passed=1 Failed=1 Skipped=1 Error=1 XFailed=1 XPassed=1' \
-                    '\nTime taken: 00:00:00' \
-                    '\nhttp://report_link.com\n'
-    with mock.patch('requests.post') as mock_post:
+    fail_sticker_id = 'CAACAgIAAxkBAAErjqBmTc3YrnVq3X41iPKf_-IByk0bMQACdQEAAonq5Qe1oIsDG4khHDUE'
+    expected_results = ' \u200e 🚀 Passed: *1*\n ☠ Failed: *1*\n 😐 Skipped: *1*\n 🗿 Errors: *1*\n'
+    expected_time_taken = '\n ⏰ Time taken: *00:00:00*'
+    expected_tail = '\nhttp://report_link.com'
+    with mock.patch('requests.Session.post') as mock_post:
+        mock_post.return_value.json.return_value = {'result': {'message_id': 1}}
         testdir.runpytest('--telegram_id', telegram_chat_id,
                           '--telegram_token', telegram_token,
                           '--telegram_report_url', telegram_report_url)
 
-        sticker_request = mock_post.mock_calls[0]
-        sticker_called_url = sticker_request[1][0]
-        send_sticker = sticker_request[2]['json']['sticker']
-        message_request = mock_post.mock_calls[4]
-        message_called_url = message_request[1][0]
-        message_text = message_request[2]['json']['text']
-        message_chat_id = message_request[2]['json']['chat_id']
+        sticker_request = mock_post.call_args_list[0]
+        sticker_called_url = sticker_request[0][0]
+        send_sticker = json.loads(sticker_request[1]['data'])['sticker']
+        message_request = mock_post.call_args_list[1]
+        message_called_url = message_request[0][0]
+        message_text = json.loads(message_request[1]['data'])['text']
+        message_chat_id = json.loads(message_request[1]['data'])['chat_id']
 
         assert sticker_called_url == f'https://api.telegram.org/bot{telegram_token}/sendSticker'
         assert message_called_url == f'https://api.telegram.org/bot{telegram_token}/sendMessage'
-        assert message_text == expected_text
+        assert message_text.startswith(expected_results)
+        assert expected_time_taken in message_text
+        assert message_text.endswith(expected_tail)
         assert message_chat_id == telegram_chat_id
         assert send_sticker == fail_sticker_id
 
@@ -76,26 +86,29 @@ def test_success_sticker_telegram(testdir):
     telegram_token = 'Token'
     telegram_chat_id = '130559633'
     telegram_report_url = 'http://report_link.com'
-    success_sticker_id = 'CAACAgIAAxkBAAMHX8roD4u8f7DCsRobma1dZNuCeBwAAlkBAAIQGm0iHZVsOV_OQB8eBA'
-    expected_text = 'Passed=1 Failed=0 Skipped=0 Error=0 XFailed=0 XPassed=0' \
-                    '\nTime taken: 00:00:00' \
-                    '\nhttp://report_link.com\n'
-    with mock.patch('requests.post') as mock_post:
+    success_sticker_id = 'CAACAgUAAxkBAAErjqJmTc3gMwxZ6lg6xlyvR9mBRFcBiwACBAADIBz8Eom6LgTD9Nq6NQQ'
+    expected_results = ' \u200e 🚀 Passed: *1*\n ☠ Failed: *0*\n 😐 Skipped: *0*\n 🗿 Errors: *0*\n'
+    expected_time_taken = '\n ⏰ Time taken: *00:00:00*'
+    expected_tail = '\nhttp://report_link.com'
+    with mock.patch('requests.Session.post') as mock_post:
+        mock_post.return_value.json.return_value = {'result': {'message_id': 1}}
         testdir.runpytest('--telegram_id', telegram_chat_id,
                           '--telegram_token', telegram_token,
                           '--telegram_report_url', telegram_report_url)
 
-        sticker_request = mock_post.mock_calls[0]
-        sticker_called_url = sticker_request[1][0]
-        send_sticker = sticker_request[2]['json']['sticker']
-        message_request = mock_post.mock_calls[4]
-        message_called_url = message_request[1][0]
-        message_text = message_request[2]['json']['text']
-        message_chat_id = message_request[2]['json']['chat_id']
+        sticker_request = mock_post.call_args_list[0]
+        sticker_called_url = sticker_request[0][0]
+        send_sticker = json.loads(sticker_request[1]['data'])['sticker']
+        message_request = mock_post.call_args_list[1]
+        message_called_url = message_request[0][0]
+        message_text = json.loads(message_request[1]['data'])['text']
+        message_chat_id = json.loads(message_request[1]['data'])['chat_id']
 
         assert sticker_called_url == f'https://api.telegram.org/bot{telegram_token}/sendSticker'
         assert message_called_url == f'https://api.telegram.org/bot{telegram_token}/sendMessage'
-        assert message_text == expected_text
+        assert message_text.startswith(expected_results)
+        assert expected_time_taken in message_text
+        assert message_text.endswith(expected_tail)
         assert message_chat_id == telegram_chat_id
         assert send_sticker == success_sticker_id
 
@@ -114,29 +127,31 @@ def test_list_failed_telegram(testdir):
     telegram_token = 'Token'
     telegram_chat_id = '130559633'
     telegram_report_url = 'http://report_link.com'
-    fail_sticker_id = 'CAACAgIAAxkBAAMIX8rohSxoNbodB1D38VZx9HI2CDwAAmIBAAIQGm0izcITZBkXtbceBA'
-    expected_text = 'Passed=0 Failed=1 Skipped=0 Error=0 XFailed=0 XPassed=0' \
-                    '\nTime taken: 00:00:00' \
-                    '\nhttp://report_link.com\n' \
-                    '\nFailed tests:' \
-                    '\ntest_list_failed_telegram.py::test_fail\n'
-    with mock.patch('requests.post') as mock_post:
+    fail_sticker_id = 'CAACAgIAAxkBAAErjqBmTc3YrnVq3X41iPKf_-IByk0bMQACdQEAAonq5Qe1oIsDG4khHDUE'
+    expected_results = ' \u200e 🚀 Passed: *0*\n ☠ Failed: *1*\n 😐 Skipped: *0*\n 🗿 Errors: *0*\n'
+    expected_time_taken = '\n ⏰ Time taken: *00:00:00*'
+    expected_tail = '\nhttp://report_link.com' \
+                    '\n\ntest\\_list\\_failed\\_telegram.py::test\\_fail - assert 1 != 1'
+    with mock.patch('requests.Session.post') as mock_post:
+        mock_post.return_value.json.return_value = {'result': {'message_id': 1}}
         testdir.runpytest('--telegram_id', telegram_chat_id,
                           '--telegram_token', telegram_token,
                           '--telegram_report_url', telegram_report_url,
                           '--telegram_list_failed')
 
-        sticker_request = mock_post.mock_calls[0]
-        sticker_called_url = sticker_request[1][0]
-        send_sticker = sticker_request[2]['json']['sticker']
-        message_request = mock_post.mock_calls[4]
-        message_called_url = message_request[1][0]
-        message_text = message_request[2]['json']['text']
-        message_chat_id = message_request[2]['json']['chat_id']
+        sticker_request = mock_post.call_args_list[0]
+        sticker_called_url = sticker_request[0][0]
+        send_sticker = json.loads(sticker_request[1]['data'])['sticker']
+        message_request = mock_post.call_args_list[1]
+        message_called_url = message_request[0][0]
+        message_text = json.loads(message_request[1]['data'])['text']
+        message_chat_id = json.loads(message_request[1]['data'])['chat_id']
 
         assert sticker_called_url == f'https://api.telegram.org/bot{telegram_token}/sendSticker'
         assert message_called_url == f'https://api.telegram.org/bot{telegram_token}/sendMessage'
-        assert message_text == expected_text
+        assert message_text.startswith(expected_results)
+        assert expected_time_taken in message_text
+        assert message_text.endswith(expected_tail)
         assert message_chat_id == telegram_chat_id
         assert send_sticker == fail_sticker_id
 
@@ -148,7 +163,7 @@ def test_list_failed_with_dots_telegram(testdir):
         """
         import pytest
         
-        @pytest.mark.parametrize('id', range(10))
+        @pytest.mark.parametrize('id', range(60))
         def test_fail(id):
             assert 1 != 1
         """
@@ -157,32 +172,31 @@ def test_list_failed_with_dots_telegram(testdir):
     telegram_token = 'Token'
     telegram_chat_id = '130559633'
     telegram_report_url = 'http://report_link.com'
-    fail_sticker_id = 'CAACAgIAAxkBAAMIX8rohSxoNbodB1D38VZx9HI2CDwAAmIBAAIQGm0izcITZBkXtbceBA'
-    expected_text = 'Passed=0 Failed=10 Skipped=0 Error=0 XFailed=0 XPassed=0' \
-                    '\nTime taken: 00:00:00' \
-                    '\nhttp://report_link.com\n' \
-                    '\nFailed tests:' \
-                    '\ntest_list_failed_with_dots_telegram.py::test_fail[0]' \
-                    '\ntest_list_failed_with_dots_telegram.py::test_fail[1]' \
-                    '\ntest_list_failed_with_dots_telegram.py::test_fail[2]' \
-                    '\n...'
-    with mock.patch('requests.post') as mock_post:
+    fail_sticker_id = 'CAACAgIAAxkBAAErjqBmTc3YrnVq3X41iPKf_-IByk0bMQACdQEAAonq5Qe1oIsDG4khHDUE'
+    expected_results = ' \u200e 🚀 Passed: *0*\n ☠ Failed: *60*\n 😐 Skipped: *0*\n 🗿 Errors: *0*\n'
+    expected_time_taken = '\n ⏰ Time taken: *00:00:00*'
+    expected_tail = '\n… and 10 more'
+    with mock.patch('requests.Session.post') as mock_post:
+        mock_post.return_value.json.return_value = {'result': {'message_id': 1}}
         testdir.runpytest('--telegram_id', telegram_chat_id,
                           '--telegram_token', telegram_token,
                           '--telegram_report_url', telegram_report_url,
                           '--telegram_list_failed')
 
-        sticker_request = mock_post.mock_calls[0]
-        sticker_called_url = sticker_request[1][0]
-        send_sticker = sticker_request[2]['json']['sticker']
-        message_request = mock_post.mock_calls[4]
-        message_called_url = message_request[1][0]
-        message_text = message_request[2]['json']['text']
-        message_chat_id = message_request[2]['json']['chat_id']
+        sticker_request = mock_post.call_args_list[0]
+        sticker_called_url = sticker_request[0][0]
+        send_sticker = json.loads(sticker_request[1]['data'])['sticker']
+        message_request = mock_post.call_args_list[1]
+        message_called_url = message_request[0][0]
+        message_text = '\n'.join(json.loads(called[1]['data'])['text'] for called in mock_post.call_args_list[1:])
+        message_chat_id = json.loads(message_request[1]['data'])['chat_id']
 
         assert sticker_called_url == f'https://api.telegram.org/bot{telegram_token}/sendSticker'
         assert message_called_url == f'https://api.telegram.org/bot{telegram_token}/sendMessage'
-        assert message_text == expected_text
+        assert message_text.startswith(expected_results)
+        assert expected_time_taken in message_text
+        assert message_text.endswith(expected_tail)
+        assert message_text.count(' - assert 1 != 1') == 50
         assert message_chat_id == telegram_chat_id
         assert send_sticker == fail_sticker_id
 
@@ -204,25 +218,279 @@ def test_time_taken(testdir):
     telegram_token = 'Token'
     telegram_chat_id = '130559633'
     telegram_report_url = 'http://report_link.com'
-    fail_sticker_id = 'CAACAgIAAxkBAAMIX8rohSxoNbodB1D38VZx9HI2CDwAAmIBAAIQGm0izcITZBkXtbceBA'
-    expected_text = 'Passed=0 Failed=1 Skipped=0 Error=0 XFailed=0 XPassed=0' \
-                    '\nTime taken: 00:00:01' \
-                    '\nhttp://report_link.com\n'
-    with mock.patch('requests.post') as mock_post:
+    fail_sticker_id = 'CAACAgIAAxkBAAErjqBmTc3YrnVq3X41iPKf_-IByk0bMQACdQEAAonq5Qe1oIsDG4khHDUE'
+    expected_results = ' \u200e 🚀 Passed: *0*\n ☠ Failed: *1*\n 😐 Skipped: *0*\n 🗿 Errors: *0*\n'
+    expected_time_taken = '\n ⏰ Time taken: *00:00:01*'
+    expected_tail = '\nhttp://report_link.com'
+    with mock.patch('requests.Session.post') as mock_post:
+        mock_post.return_value.json.return_value = {'result': {'message_id': 1}}
         testdir.runpytest('--telegram_id', telegram_chat_id,
                           '--telegram_token', telegram_token,
                           '--telegram_report_url', telegram_report_url)
 
-        sticker_request = mock_post.mock_calls[0]
-        sticker_called_url = sticker_request[1][0]
-        send_sticker = sticker_request[2]['json']['sticker']
-        message_request = mock_post.mock_calls[4]
-        message_called_url = message_request[1][0]
-        message_text = message_request[2]['json']['text']
-        message_chat_id = message_request[2]['json']['chat_id']
+        sticker_request = mock_post.call_args_list[0]
+        sticker_called_url = sticker_request[0][0]
+        send_sticker = json.loads(sticker_request[1]['data'])['sticker']
+        message_request = mock_post.call_args_list[1]
+        message_called_url = message_request[0][0]
+        message_text = json.loads(message_request[1]['data'])['text']
+        message_chat_id = json.loads(message_request[1]['data'])['chat_id']
 
         assert sticker_called_url == f'https://api.telegram.org/bot{telegram_token}/sendSticker'
         assert message_called_url == f'https://api.telegram.org/bot{telegram_token}/sendMessage'
-        assert message_text == expected_text
+        assert message_text.startswith(expected_results)
+        assert expected_time_taken in message_text
+        assert message_text.endswith(expected_tail)
         assert message_chat_id == telegram_chat_id
-        assert send_sticker == fail_sticker_id
\ No newline at end of file
+        assert send_sticker == fail_sticker_id
+
+
+def test_session_timeout(testdir):
+    """Make sure plugin sends all requests through one session with timeouts."""
+
+    testdir.makepyfile(
+        """
+        import pytest
+        def test_pass():
+            assert 1 == 1
+        """
+    )
+
+    with mock.patch('requests.Session.post') as mock_post:
+        mock_post.return_value.json.return_value = {'result': {'message_id': 1}}
+        testdir.runpytest('--telegram_id', '130559633',
+                          '--telegram_token', 'Token')
+
+        assert mock_post.call_count == 2
+        for called in mock_post.call_args_list:
+            assert called[1]['timeout'] == (3.05, 10)
+
+
+def test_summary_message(testdir):
+    """Make sure plugin sends summary with counts, environment and report url."""
+
+    testdir.makepyfile(
+        """
+        import pytest
+        def test_pass():
+            assert 1 == 1
+
+
+        def test_fail():
+            assert 1 == 2
+        """
+    )
+
+    with mock.patch('requests.Session.post') as mock_post:
+        mock_post.return_value.json.return_value = {'result': {'message_id': 1}}
+        testdir.runpytest('--telegram_id', '130559633',
+                          '--telegram_token', 'Token',
+                          '--telegram_env', 'staging',
+                          '--telegram_report_url', 'http://report_link.com',
+                          '--telegram_custom_text', 'Line 1\\nLine 2')
+
+        payloads = [json.loads(called[1]['data']) for called in mock_post.call_args_list]
+        message_text = next(payload['text'] for payload in payloads if 'parse_mode' in payload)
+
+        assert 'Passed: *1*' in message_text
+        assert 'Failed: *1*' in message_text
+        assert 'Time taken: *00:00:00*' in message_text
+        assert 'Environment: *staging*' in message_text
+        assert message_text.endswith('\nhttp://report_link.com\nLine 1\nLine 2')
+
+
+def test_collect_only(testdir):
+    """Make sure plugin sends nothing when tests are not run."""
+
+    testdir.makepyfile(
+        """
+        import pytest
+        def test_pass():
+            assert 1 == 1
+        """
+    )
+
+    with mock.patch('requests.Session.post') as mock_post:
+        mock_post.return_value.json.return_value = {'result': {'message_id': 1}}
+        testdir.runpytest('--telegram_id', '130559633',
+                          '--telegram_token', 'Token',
+                          '--collect-only')
+        testdir.runpytest('--telegram_id', '130559633',
+                          '--telegram_token', 'Token',
+                          '-k', 'nothing')
+
+        assert not mock_post.called
+
+
+def test_failed_tests_in_summary(testdir):
+    """Make sure plugin sends short failed tests list within the summary message."""
+
+    testdir.makepyfile(
+        """
+        import pytest
+        def test_fail():
+            assert 1 == 2
+        """
+    )
+
+    with mock.patch('requests.Session.post') as mock_post:
+        mock_post.return_value.json.return_value = {'result': {'message_id': 1}}
+        testdir.runpytest('--telegram_id', '130559633',
+                          '--telegram_token', 'Token',
+                          '--telegram_list_failed')
+
+        message_request = mock_post.call_args_list[1]
+        message_text = json.loads(message_request[1]['data'])['text']
+
+        assert mock_post.call_count == 2
+        assert message_text.endswith('\n\ntest\\_failed\\_tests\\_in\\_summary.py::test\\_fail - assert 1 == 2')
+
+
+def test_missing_chat_id(testdir):
+    """Make sure plugin sends nothing without chat id."""
+
+    testdir.makepyfile(
+        """
+        import pytest
+        def test_pass():
+            assert 1 == 1
+        """
+    )
+
+    with mock.patch('requests.Session.post') as mock_post:
+        testdir.runpytest('--telegram_token', 'Token')
+
+        assert not mock_post.called
+
+
+def test_session_start_time():
+    """Make sure plugin reads the session start time on pytest 8.4 and newer."""
+
+    from pytest_telegram.plugin import _session_start_time
+
+    terminalreporter = SimpleNamespace(_session_start=SimpleNamespace(time=1700000000.5))
+
+    assert _session_start_time(terminalreporter) == 1700000000.5
+
+
+def test_session_start_time_before_pytest_8_4():
+    """Make sure plugin reads the session start time on pytest older than 8.4."""
+
+    from pytest_telegram.plugin import _session_start_time
+
+    terminalreporter = SimpleNamespace(_sessionstarttime=1700000000.5)
+
+    assert _session_start_time(terminalreporter) == 1700000000.5
+
+
+def test_long_failed_tests_list(testdir):
+    """Make sure plugin limits long failed tests list and splits it into several messages."""
+
+    testdir.makepyfile(
+        """
+        import pytest
+
+        @pytest.mark.parametrize('id', range(200))
+        def test_fail(id):
+            assert id == 'x' * 500
+        """
+    )
+
+    with mock.patch('requests.Session.post') as mock_post:
+        mock_post.return_value.json.return_value = {'result': {'message_id': 1}}
+        testdir.runpytest('--telegram_id', '130559633',
+                          '--telegram_token', 'Token',
+                          '--telegram_list_failed')
+
+        payloads = [json.loads(called[1]['data']) for called in mock_post.call_args_list]
+        failed_texts = [payload['text'] for payload in payloads[1:] if 'parse_mode' not in payload]
+        failed_lines = '\n'.join(failed_texts).split('\n')
+
+        assert 'parse_mode' in payloads[1]
+        assert len(failed_texts) > 1
+        assert all(len(text) <= 4096 for text in failed_texts)
+        assert len(failed_lines) == 51
+        assert all(len(line) <= 400 for line in failed_lines)
+        assert failed_lines[0].startswith('test_long_failed_tests_list.py::test_fail[0] - ')
+        assert failed_lines[49].startswith('test_long_failed_tests_list.py::test_fail[49] - ')
+        assert failed_lines[50] == '… and 150 more'
+
+
+def _telegram_response(status):
+    # Response as returned by the connection pool, so that the session adapter decides on retries
+    return urllib3.HTTPResponse(body=io.BytesIO(b'{"ok": true, "result": {"message_id": 1}}'), status=status,
+                                headers={'Content-Type': 'application/json'}, preload_content=False)
+
+
+def test_retry_too_many_requests(testdir):
+    """Make sure plugin retries a message rejected by Telegram flood control."""
+
+    testdir.makepyfile(
+        """
+        import pytest
+        def test_pass():
+            assert 1 == 1
+        """
+    )
+
+    with mock.patch('urllib3.connectionpool.HTTPConnectionPool._make_request',
+                    side_effect=[_telegram_response(429), _telegram_response(200)]) as mock_request, \
+            mock.patch('pytest_telegram.plugin.logger') as mock_logger:
+        result = testdir.runpytest('--telegram_id', '130559633',
+                                   '--telegram_token', 'Token',
+                                   '--telegram_disable_stickers')
+
+        result.assert_outcomes(passed=1)
+        assert mock_request.call_count == 2
+        assert not mock_logger.warning.called
+        assert not mock_logger.error.called
+
+
+def test_no_retry_server_error(testdir):
+    """Make sure plugin doesn't retry a message which may have been delivered."""
+
+    testdir.makepyfile(
+        """
+        import pytest
+        def test_pass():
+            assert 1 == 1
+        """
+    )
+
+    with mock.patch('urllib3.connectionpool.HTTPConnectionPool._make_request',
+                    return_value=_telegram_response(500)) as mock_request, \
+            mock.patch('pytest_telegram.plugin.logger') as mock_logger:
+        result = testdir.runpytest('--telegram_id', '130559633',
+                                   '--telegram_token', 'Token',
+                                   '--telegram_disable_stickers')
+
+        result.assert_outcomes(passed=1)
+        assert mock_request.call_count == 1
+        assert mock_logger.error.call_args_list[0][0][0] == "Error sending Telegram message: %s"
+        mock_logger.error.assert_called_with("Telegram response body for %s: %s", 'summary message',
+                                             '{"ok": true, "result": {"message_id": 1}}')
+
+
+def test_read_timeout(testdir):
+    """Make sure plugin logs a warning without retrying when Telegram doesn't respond in time."""
+
+    testdir.makepyfile(
+        """
+        import pytest
+        def test_pass():
+            assert 1 == 1
+        """
+    )
+
+    read_timeout = urllib3.exceptions.ReadTimeoutError(None, '/botToken/sendMessage', 'Read timed out.')
+    with mock.patch('urllib3.connectionpool.HTTPConnectionPool._make_request',
+                    side_effect=read_timeout) as mock_request, \
+            mock.patch('pytest_telegram.plugin.logger') as mock_logger:
+        result = testdir.runpytest('--telegram_id', '130559633',
+                                   '--telegram_token', 'Token',
+                                   '--telegram_disable_stickers')
+
+        result.assert_outcomes(passed=1)
+        assert mock_request.call_count == 1
+        mock_logger.warning.assert_called_once_with("Timed out sending Telegram message: %s", mock.ANY)
+        assert not mock_logger.error.called